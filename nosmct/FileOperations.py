@@ -2,7 +2,7 @@
 # Author: Andrew Piroli
 # Year: 2021-2022
 import pathlib
-from typing import Iterator, List, Union, Optional
+from typing import Iterator, Optional, Tuple, Union
 import os
 import logging
 
@@ -11,6 +11,10 @@ illegals = list(' <>:\\/|?*$"')
 illegals.extend(["CON", "PRN", "AUX", "NUL", "COM", "LPT", ".."])
 illegals.extend([chr(i) for i in range(0, 32)])
 
+# Resolved once at import: getLogger takes the logging module's global lock on every call,
+# no reason to pay that per function call
+logger = logging.getLogger("nosmct")
+
 
 def abspath(name: Union[str, pathlib.Path]) -> pathlib.Path:
     """Return a absolute Path object given an existing Path object or a string representing a path"""
@@ -27,21 +31,20 @@ def sanitize_filename(filename: str) -> str:
     return filename
 
 
-def set_dir(name: Union[str, pathlib.Path]):
+def ensure_dir(name: Union[str, pathlib.Path]) -> pathlib.Path:
     """
-    Helper function to create (and handle existing) folders and change directory to them automatically.
+    Helper function to create (and handle existing) folders, returning the absolute path to them.
+    Never changes the working directory: the cwd is process-wide state, so concurrent workers must
+    address their output with absolute paths instead.
     """
-    logger = logging.getLogger("nosmct")
-    try:
-        abspath(name).mkdir(parents=True, exist_ok=True)
-        logger.debug(f"set_dir: abspath({name}).mkdir()")
-    except Exception as e:
-        logger.warning(f"Could not create {name} directory in {os.getcwd()}\nReason {e}")
+    path = abspath(name)
     try:
-        os.chdir(name)
-        logger.debug(f"set_dir: os.chdir({name})")
-    except Exception as e:
-        logger.warning(f"Could not change to {name} directory from {os.getcwd()}\nReason {e}")
+        # os.makedirs directly, Path.mkdir(parents=True) walks the parents itself with extra stat calls
+        os.makedirs(path, exist_ok=True)
+        logger.debug("ensure_dir: makedirs(%s)", path)
+    except OSError as e:
+        logger.warning("Could not create %s directory in %s\nReason %s", name, os.getcwd(), e)
+    return path
 
 
 def load_jobfile(filename: pathlib.Path) -> Iterator[str]:
@@ -57,13 +60,15 @@ def load_jobfile(filename: pathlib.Path) -> Iterator[str]:
 
 def preload_jobfile(
     jobfile: Optional[pathlib.Path],
-) -> Optional[List[str]]:
+) -> Optional[Tuple[Tuple[str, str], ...]]:
     """
     Like load_jobfile, but consumes the generator fully so the entire file may be cached.
+    Each entry is a (command, output filename) pair - the filename is sanitized here, once, instead
+    of for every device that runs the command.
+    The cache is a tuple: it's shared by every worker, so it should be immutable.
     """
-    logger = logging.getLogger("nosmct")
     if not jobfile:
         return None
-    result = list(load_jobfile(jobfile))
-    logger.debug(f"Added {jobfile} to cache")
+    result = tuple((cmd, f"{sanitize_filename(cmd)}.txt") for cmd in load_jobfile(jobfile))
+    logger.debug("Added %s to cache", jobfile)
     return result
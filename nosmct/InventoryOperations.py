@@ -2,12 +2,13 @@
 # Author: Andrew Piroli
 # Year: 2022
 import csv
+import functools
 import json
 import pathlib
 import re
 import logging
 from typing import Iterator, List, Literal, Optional, Union
-from dataclasses import dataclass
+from dataclasses import dataclass, field as dc_field
 from constants import LIBRENMS_API_BASE_URL
 
 try:
@@ -17,37 +18,116 @@ try:
 except ImportError:
     HAVE_REQUESTS = False
 
+try:
+    import orjson
+
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+
+def _json_loads(data: Union[str, bytes]) -> dict:
+    """
+    Parse JSON from a string/bytes, preferring orjson when installed.
+    orjson is several times faster than the stdlib on large device inventories, but like requests it's optional.
+    """
+    return orjson.loads(data) if HAVE_ORJSON else json.loads(data)
+
+
+# Resolved once at import: getLogger takes the logging module's global lock on every call,
+# no reason to pay that per function call
+logger = logging.getLogger("nosmct")
+
+# Sentinel to tell a missing device field apart from a legitimately falsy value
+_MISSING = object()
+
 
-@dataclass(repr=True, order=True)
+@dataclass(repr=True, order=True, frozen=True, slots=True)
 class FilterEntry:
     field: str
     qualifier: Union[Literal["EQ"], Literal["LIKE"]]
     qualifiees: Union[str, List[str]]
     inverted: bool
     must_match_all: bool
+    # Compiled forms of qualifiees for LIKE filters, built once in __post_init__
+    _compiled: Optional[List[re.Pattern]] = dc_field(default=None, init=False, repr=False, compare=False)
+    _combined: Optional[re.Pattern] = dc_field(default=None, init=False, repr=False, compare=False)
+    # Stringified qualifiees for EQ filters, membership is a single O(1) hash probe
+    _eq_set: Optional[frozenset] = dc_field(default=None, init=False, repr=False, compare=False)
+    # Raw (pre-inversion) verdict per unique field string, safe because the instance is frozen
+    _cache: dict = dc_field(default_factory=dict, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Normalize qualifiees to a list once up front, ismatch is called per (device x filter)
+        # and shouldn't waste time checking every call. frozen=True means we go through object.__setattr__
+        if not isinstance(self.qualifiees, list):
+            object.__setattr__(
+                self,
+                "qualifiees",
+                [
+                    self.qualifiees,
+                ],
+            )
+        if self.qualifier == "LIKE":
+            # Compile at construction so ismatch never re-enters the re module (and its cache lookup)
+            # per candidate. This also makes a broken pattern fail here, at load time, instead of
+            # somewhere deep in the per-device loop. The combined alternation lets the any-match
+            # case do a single scan.
+            try:
+                compiled = [re.compile(str(candidate)) for candidate in self.qualifiees]
+            except re.error as err:
+                raise ValueError(
+                    f"Invalid filter pattern {err.pattern!r} for field {self.field!r}: {err}"
+                ) from err
+            object.__setattr__(self, "_compiled", compiled)
+            # No patterns means no alternation: joining an empty list would compile to the empty
+            # pattern, which matches everything, the opposite of the zero-matches verdict
+            if compiled:
+                object.__setattr__(
+                    self, "_combined", re.compile("|".join(f"(?:{c.pattern})" for c in compiled))
+                )
+        elif self.qualifier == "EQ":
+            # str() the candidates once here, not per device in ismatch
+            object.__setattr__(self, "_eq_set", frozenset(str(candidate) for candidate in self.qualifiees))
 
     def ismatch(self, x: dict) -> bool:
-        if self.field not in x:
+        # One .get with a sentinel instead of a containment check followed by a second hash probe
+        to_match = x.get(self.field, _MISSING)
+        if to_match is _MISSING:
             raise RuntimeError("Undefined behavior")
-        to_match = str(x[self.field])
-        if not isinstance(self.qualifiees, list):
-            self.qualifiees = [
-                self.qualifiees,
-            ]
-        matches = 0
-        for candidate in self.qualifiees:
-            if self.qualifier == "EQ":
-                matches += 1 if to_match == str(candidate) else 0
-            elif self.qualifier == "LIKE":
-                matches += 1 if re.search(str(candidate), to_match) else 0
-            else:
-                raise RuntimeError("unreachable FilterQualifer")
-        if self.must_match_all:
-            return (len(self.qualifiees) == matches) != self.inverted
-        else:
-            return (matches > 0) != self.inverted
+        to_match = str(to_match)
+        # Inventories repeat the same os/type/hardware strings across thousands of devices, so
+        # remember the verdict per unique string and only evaluate new ones
+        matched = self._cache.get(to_match)
+        if matched is None:
+            matched = self._cache[to_match] = self._evaluate(to_match)
+        return matched != self.inverted
+
+    def _evaluate(self, to_match: str) -> bool:
+        """Raw qualifiees-match verdict, inversion is applied by ismatch"""
+        if self.qualifier == "LIKE":
+            if self.must_match_all:
+                # First miss decides the outcome, don't bother finishing the list
+                for pattern in self._compiled:
+                    if not pattern.search(to_match):
+                        return False
+                return True
+            # One scan over the combined alternation instead of len(qualifiees) separate searches.
+            # _combined is None when there are no patterns, and zero patterns can't match anything.
+            return self._combined is not None and self._combined.search(to_match) is not None
+        elif self.qualifier == "EQ":
+            if self.must_match_all:
+                # Every candidate equals to_match only when the deduplicated set is exactly
+                # {to_match}. Zero candidates is vacuously true, like the baseline counting loop.
+                if not self._eq_set:
+                    return True
+                return len(self._eq_set) == 1 and to_match in self._eq_set
+            return to_match in self._eq_set
+        raise RuntimeError("unreachable FilterQualifer")
 
 
+# These all get folded into a single compiled alternation by FilterEntry.__post_init__, so the
+# whole list costs one regex scan per device, paid once at import time for DEFAULT_FILTER.
 BAD_OS = [
     r"windows",
     r"linux",
@@ -65,106 +145,146 @@ BAD_OS = [
 DEFAULT_FILTER = FilterEntry("os", "LIKE", BAD_OS, inverted=True, must_match_all=False)
 
 
-def read_csv_config(filename: pathlib.Path) -> Iterator[dict]:
+@functools.lru_cache(maxsize=8)
+def _make_row_builder(header: tuple):
+    """
+    Generate a row -> dict function specialized to this file's header.
+    Hardcoding the keys and indices into a dict literal skips the per-row zip() and dict() machinery,
+    which adds up on big inventories. Builders are cached by header tuple, so re-reading inventories
+    that share a layout doesn't even pay the one-time compile again.
+    Rows stay plain dicts rather than namedtuples because ConnectHandler(**info) needs a mapping.
+    """
+    src = "def _build_row(row): return {" + ", ".join(f"{h!r}: row[{i}]" for i, h in enumerate(header)) + "}"
+    namespace: dict = {}
+    exec(compile(src, "<read_csv_config>", "exec"), namespace)
+    return namespace["_build_row"]
+
+
+def read_csv_config(filename: pathlib.Path, dialect=None) -> Iterator[dict]:
     """
     Generator function to processes the CSV config file. Handles the various CSV formats and stitches the header onto each entry.
+    Callers that already know their format can pass `dialect` (a csv.Dialect or registered dialect
+    name like "excel") to skip auto-detection entirely.
     """
-    logger = logging.getLogger("nosmct")
     with open(filename, "r") as config_file:
-        logger.debug(f"read_config: filename: {filename}")
-        try:
-            contents = [
-                next(config_file) for _ in range(2)
-            ]  # Reading 2 lines of the CSV, is sufficient to detect style
-        except (
-            StopIteration
-        ):  # Only occurs when the file has less than two lines....not a very useful file, but I'm ready for it
-            pass
-        finally:
-            full_contents = "".join(contents)
+        logger.debug("read_config: filename: %s", filename)
+        if dialect is None:
+            # Sniff the dialect from a bounded prefix. Two lines was occasionally too little to detect
+            # the style reliably, and an unbounded sample would let the sniffer's regexes chew on the
+            # whole file; 64KB covers plenty of rows while keeping detection cost flat.
+            sample = config_file.read(65536)
+            dialect = csv.Sniffer().sniff(sample)  # Detect CSV style
+            del sample
             config_file.seek(0)
-        dialect = csv.Sniffer().sniff(full_contents)  # Detect CSV style
-        del contents, full_contents
         reader = csv.reader(config_file, dialect)
         header = next(reader)
-        logger.debug(f"read_config: header: {header}")
+        logger.debug("read_config: header: %s", header)
+        build_row = _make_row_builder(tuple(header))
+        header_len = len(header)
         for config_entry in reader:
-            yield dict(zip(header, config_entry))
-
-
-# Check if a key exists
-lnms_config_exists = lambda key, config: (key in config)
-# Set a key to some default value if it doesn't exist
-lnms_config_default = (
-    lambda key, default, config: config.__setitem__(key, default) if key not in config else None
-)
-# Check a key exists and it's value against a list of valid options
-lnms_config_require = lambda key, valid_options, config: (key in config and config[key] in valid_options)
+            # csv.reader yields [] for blank lines and short lists for ragged rows; the generated
+            # builder indexes every header column, so skip those instead of crashing the whole run
+            if len(config_entry) < header_len:
+                logger.warning("read_config: skipping short row: %r", config_entry)
+                continue
+            yield build_row(config_entry)
 
 
 def lnms_config_validate_and_set_defaults(config: dict) -> bool:
     """
     Validate and fill in missing defaults for the loaded LibreNMS config
     """
-    logger = logging.getLogger("nosmct")
     if not isinstance(config, dict):
         logger.critical("Error: LibreNMS config malformed (not dict)")
         return False
     for required_key in ("host", "api_key", "filters", "username", "password"):
-        if not lnms_config_exists(required_key, config):
-            logger.critical(f"Required config key: {required_key} not found in LibreNMS config")
+        if required_key not in config:
+            logger.critical("Required config key: %s not found in LibreNMS config", required_key)
             return False
-    lnms_config_default("protocol", "https", config)
-    if not lnms_config_require("protocol", ("http", "https"), config):
-        logger.critical("LibreNMS config invalid protocol: " + config["protocol"])
+    config.setdefault("protocol", "https")
+    if config["protocol"] not in ("http", "https"):
+        logger.critical("LibreNMS config invalid protocol: %s", config["protocol"])
         return False
-    if not lnms_config_exists("port", config):
+    if "port" not in config:
         config["port"] = 80 if config["protocol"] == "http" else 443
     elif not isinstance(config["port"], int):
         config["port"] = int(config["port"])
-    if not lnms_config_require("port", range(65536), config):
-        logger.critical("Invalid port no: " + config["port"])
+    if not 0 <= config["port"] < 65536:
+        logger.critical("Invalid port no: %s", config["port"])
         return False
-    if not lnms_config_exists("tls_verify", config):
-        lnms_config_default("tls_verify", (config["protocol"] == "https"), config)
-    elif not lnms_config_require("tls_verify", (True, False), config):
+    if "tls_verify" not in config:
+        config["tls_verify"] = config["protocol"] == "https"
+    elif config["tls_verify"] not in (True, False):
         logger.critical("LibreNMS config key tls_verify must be true or false")
         return False
     if not isinstance(config["api_key"], str):
         logger.critical("LibreNMS config key api_key must be a string")
         return False
-    lnms_config_default("filters", [], config)
+    config.setdefault("filters", [])
     if not isinstance(config["filters"], list):
         logger.critical("LibreNMS config 'filters' must be a list")
         return False
-    lnms_config_default("secret", config["password"], config)
+    config.setdefault("secret", config["password"])
     return True
 
 
-def lnms_query(config: dict, endpoint: str) -> Optional[dict]:
+# One Session shared by all LibreNMS queries so keep-alive amortizes the TCP+TLS handshake across calls.
+# Created lazily because requests may not be installed at all.
+_lnms_session = None
+
+
+def _get_lnms_session():
+    global _lnms_session
+    if _lnms_session is None:
+        _lnms_session = requests.Session()
+        # Small explicit pool, every query goes to the one LibreNMS host
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        _lnms_session.mount("https://", adapter)
+        _lnms_session.mount("http://", adapter)
+    return _lnms_session
+
+
+def close_lnms_session():
+    """
+    Release the pooled LibreNMS connections. Safe to call even if no query was ever made.
+    """
+    global _lnms_session
+    if _lnms_session is not None:
+        _lnms_session.close()
+        _lnms_session = None
+
+
+def lnms_query(config: dict, endpoint: str, params: Optional[dict] = None) -> Optional[dict]:
     """
     Perform a LibreNMS GET request and return the JSON response
+    Optional query string parameters may be given via `params`
     """
     if not HAVE_REQUESTS:
         return None
     protocol = config["protocol"]
     host = config["host"]
     tls_verify = config["tls_verify"]
-    headers = {"X-Auth-Token": config["api_key"]}
     port = ":" + str(config["port"])
-    response = requests.get(
+    session = _get_lnms_session()
+    # The api_key doesn't change between queries, stash it on the session instead of rebuilding
+    # a headers dict per call
+    if "X-Auth-Token" not in session.headers:
+        session.headers["X-Auth-Token"] = config["api_key"]
+        # Big device inventories compress well as JSON, make sure the server knows we take gzip
+        session.headers["Accept"] = "application/json"
+        session.headers["Accept-Encoding"] = "gzip, deflate"
+    response = session.get(
         f"{protocol}://{host}{port}{LIBRENMS_API_BASE_URL}{endpoint}",
-        headers=headers,
         verify=tls_verify,
-    ).json()
-    return response
+        params=params,
+    )
+    return _json_loads(response.content)
 
 
 def validate_lnms_response(response: dict) -> bool:
     """
     Run basic checks on the response data from LibreNMS
     """
-    logger = logging.getLogger("nosmct")
     if not isinstance(response, dict):
         logger.critical("Invalid response from LibreNMS API")
         return False
@@ -181,31 +301,66 @@ def lnms_run_filter(devices: list, filter: FilterEntry) -> List[dict]:
     """
     Run a single FilterEntry on the device list data
     """
-    passed = list()
-    for device in devices:
-        if not isinstance(device, dict):
-            continue
-        if filter.ismatch(device):
-            passed.append(device)
-    return passed
+    # Comprehension instead of append-in-a-loop: no method lookup/call per device.
+    # The bound method and builtin are hoisted to locals so the per-device cost is two LOAD_FASTs
+    # instead of a LOAD_GLOBAL plus attribute resolution on every iteration.
+    ismatch = filter.ismatch
+    _isinstance = isinstance
+    return [device for device in devices if _isinstance(device, dict) and ismatch(device)]
+
+
+def lnms_build_fused_predicate(filters: List[FilterEntry]):
+    """
+    Fuse a filter chain into one generated predicate so the device list is scanned a single time.
+    The exec'd source is a plain `and` chain over the filters' bound ismatch methods, which gives
+    bytecode-level short-circuiting: a device rejected by the first filter never touches the rest.
+    """
+    namespace = {f"_f{i}": a_filter.ismatch for i, a_filter in enumerate(filters)}
+    body = " and ".join(f"_f{i}(device)" for i in range(len(filters))) or "True"
+    exec(compile(f"def pred(device): return {body}", "<lnms_build_fused_predicate>", "exec"), namespace)
+    return namespace["pred"]
 
 
 def lnms_parse_filters(filterconfig: List[dict]) -> List[FilterEntry]:
     """
     Parse the list of filters from JSON/dict to FilterEntry objects
+    Invalid entries (unknown keys, broken regex patterns) are logged and skipped rather than
+    crashing the inventory pull partway through.
     """
     filters = []
     if not isinstance(filterconfig, list):
         return filters
     for potential_filter in filterconfig:
-        parsed_filter = FilterEntry(**potential_filter)
-        if isinstance(parsed_filter, FilterEntry):
-            filters.append(parsed_filter)
+        try:
+            filters.append(FilterEntry(**potential_filter))
+        except (TypeError, ValueError) as err:
+            logger.critical("Skipping invalid filter %s: %s", potential_filter, err)
     return filters
 
 
 lnms_to_netmiko_lut = {"ios": "cisco_ios", "iosxe": "cisco_ios"}
 
+# Fields the LibreNMS /devices endpoint can pre-filter on via ?type=<field>&query=<value>
+lnms_server_filterable = ("os", "location", "hostname", "sysName", "ipv4", "ipv6", "mac")
+
+
+def lnms_server_side_params(filters: List[FilterEntry]) -> Optional[dict]:
+    """
+    Pick a filter that LibreNMS can evaluate server-side and translate it to query parameters.
+    Only a plain single-value equality on a supported field qualifies, and the API takes a single
+    type/query pair, so the first eligible filter wins. All filters are still applied client-side
+    afterwards; this just shrinks the response before it crosses the wire.
+    """
+    for a_filter in filters:
+        if (
+            a_filter.qualifier == "EQ"
+            and not a_filter.inverted
+            and a_filter.field in lnms_server_filterable
+            and len(a_filter.qualifiees) == 1
+        ):
+            return {"type": a_filter.field, "query": str(a_filter.qualifiees[0])}
+    return None
+
 
 def get_inventory_from_lnms(filename: pathlib.Path) -> Optional[Iterator[dict]]:
     """
@@ -218,25 +373,23 @@ def get_inventory_from_lnms(filename: pathlib.Path) -> Optional[Iterator[dict]]:
      - filters to apply to the data
      - network device login data
     """
-    logger = logging.getLogger("nosmct")
     if not HAVE_REQUESTS:
         logger.critical(
             "requests library not installed. Please install it via pip to support LibreNMS integration"
         )
         return None
     with open(filename, "r") as config_file:
-        confdata = json.load(config_file)
+        confdata = _json_loads(config_file.read())
     if not lnms_config_validate_and_set_defaults(confdata):
         logger.critical("LibreNMS config validation failed")
         return None
-    response = lnms_query(confdata, "devices")
+    parsed_filters = lnms_parse_filters(confdata["filters"])
+    response = lnms_query(confdata, "devices", params=lnms_server_side_params(parsed_filters))
     if not validate_lnms_response(response):
         logger.critical("LibreNMS response validation failed")
         return None
-    parsed_filters = lnms_parse_filters(confdata["filters"])
-    devices = lnms_run_filter(response["devices"], DEFAULT_FILTER)
-    for a_filter in parsed_filters:
-        devices = lnms_run_filter(devices, a_filter)
+    pred = lnms_build_fused_predicate([DEFAULT_FILTER] + parsed_filters)
+    devices = [device for device in response["devices"] if isinstance(device, dict) and pred(device)]
     for dev in devices:
         conn_addr = None
         if len(dev["ip"].strip()):
@@ -7,8 +7,10 @@ import argparse
 import os
 import logging
 import logging.handlers
+from queue import Empty
 from sys import argv, stdout, stderr
-from concurrent.futures import ProcessPoolExecutor, wait
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from time import perf_counter_ns
 from netmiko import ConnectHandler  # type: ignore
 from netmiko import NetmikoAuthenticationException, NetmikoTimeoutException
@@ -19,58 +21,132 @@ from constants import (
 )
 from FileOperations import (
     abspath,
-    set_dir,
+    ensure_dir,
     load_jobfile,
     preload_jobfile,
     sanitize_filename,
 )
-from InventoryOperations import read_csv_config, get_inventory_from_lnms
+from InventoryOperations import read_csv_config, get_inventory_from_lnms, close_lnms_session
 
 """
 `p_config` dictionary contains configuration info on how the function itself should operate. It contains:
   mode is class OperatingMode, which tells the process how to interpret the jobs
   log_level is the configured logging level
   jobfile is the path to the jobfile incase it's not already loaded
-  jobfile_cache is a dict with a cached list of commands for each device_type
+  jobfile_cache is a cached tuple of (command, output filename) pairs, or None when caching is disabled
   netmiko_debug is a path to a debug file, if present, it will log raw io for each device.
   output_dir is a path to the selected output directory. By default this is Output/<TIMESTAMP> but it may be overridden
 """
 global p_config
 p_config = {}
 
+# Resolved once at import: getLogger takes the logging module's global lock on every call,
+# and run() would otherwise pay that per device
+logger = logging.getLogger("nosmct")
 
-def run(info: dict):
+
+def _do_pull(connection, hostname: str, jobfile, logger, host: str):
+    """Pull mode: run every jobfile command and save each output to its own file in the device folder"""
+    debug_enabled = p_config["log_level"] <= logging.DEBUG
+    host_dir = ensure_dir(p_config["output_dir"] / hostname)
+    # Collect outputs while the SSH round-trips happen, then do all the file writes back to back.
+    # The command loop stays purely network-bound and the write syscalls batch together instead of
+    # interleaving an open/write/close between every prompt wait.
+    results = []
+    for cmd, filename in jobfile:
+        if debug_enabled:
+            logger.debug("run: Got filename: %s for %s", filename, host)
+        results.append((filename, connection.send_command(cmd)))
+    for filename, output in results:
+        # Each file is written whole from a single string, so the io-layer buffering is pure
+        # overhead: go straight to the syscalls, one open/write/close per file
+        fd = os.open(host_dir / filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, output.encode())
+        finally:
+            os.close(fd)
+
+
+def _do_push(connection, hostname: str, jobfile, logger, host: str):
+    """Push mode: send the jobfile as a config set and keep a transcript in the device folder"""
+    host_dir = ensure_dir(p_config["output_dir"] / hostname)
+    # Filename here is not derived from any user controlled source, no need to run it through the sanitizer
+    filename = "configset.txt"
+    try:
+        with open(host_dir / filename, "w") as output_file:
+            output_file.write(connection.send_config_set([cmd for cmd, _ in jobfile]))
+    except NetmikoTimeoutException:
+        # Pass this up to the outer try/except
+        raise
+    finally:
+        # No matter what happens, I don't want to leave a device without at least trying to save the config
+        connection.save_config()
+
+
+def _do_save(connection, hostname: str, jobfile, logger, host: str):
+    """SaveOnly mode: just write the running config to startup"""
+    connection.save_config()
+    logger.info("Saved config for %s", host)
+
+
+# Selected once in main so workers don't re-branch on the mode for every device
+MODE_HANDLERS = {
+    OperatingModes.Pull: _do_pull,
+    OperatingModes.Push: _do_push,
+    OperatingModes.SaveOnly: _do_save,
+}
+
+
+_worker_setup_lock = threading.Lock()
+_worker_setup_done = False
+
+
+def _init_worker(config: dict, log_q):
+    """
+    Pool initializer. The workers are threads sharing this process, so the logger wiring has to
+    happen exactly once no matter how many pool threads spin up - first thread in does the work.
+    """
+    global p_config, _worker_setup_done
+    with _worker_setup_lock:
+        if _worker_setup_done:
+            return
+        _worker_setup_done = True
+        p_config.update(config)
+        # main already attached a QueueHandler to this (shared) logger, don't double up
+        if not any(isinstance(handler, logging.handlers.QueueHandler) for handler in logger.handlers):
+            logger.addHandler(logging.handlers.QueueHandler(log_q))
+            logger.setLevel(config["log_level"])
+        # Configure logging for netmiko
+        nm_logger = logging.getLogger("netmiko")
+        # Remove their default handler because it doesn't really work with my crappy logging sytstem I cooked up
+        nm_logger.removeHandler(nm_logger.handlers[0])
+        if p_config["netmiko_debug"] is not None:
+            nm_logger.setLevel(logging.DEBUG)
+            nm_log_fh = logging.FileHandler(str(p_config["netmiko_debug"]) + f"{os.getpid()}.log")
+            nm_logger.addHandler(nm_log_fh)
+        else:
+            nm_logger.addHandler(logging.NullHandler())
+        nm_logger.propagate = False
+
+
+def run(info: dict, mode_handler):
     """
     Worker thread running in process
-    Creates a connection to the specified device, creates a folder for it, and runs throuigh the jobfile saving the results to the folder
+    Creates a connection to the specified device and hands it off to the mode-specialized handler
     `info` dict contains device information like ip/hostname, device type, and login details
     `info` is passed directly to netmiko's `ConnectHandler` via kwargs dictionary unpacking
     """
     global p_config
-    logger = logging.getLogger("nosmct")
-    original_directory = p_config["output_dir"]
-    mode = p_config["mode"]
     jobfile = p_config["jobfile"]
     jobfile_cache = p_config["jobfile_cache"]
     #
     host = info["host"]
-    logger.info(f"running - {host}")
-    # Configure logging for netmiko
-    nm_logger = logging.getLogger("netmiko")
-    # Remove their default handler because it doesn't really work with my crappy logging sytstem I cooked up
-    nm_logger.removeHandler(nm_logger.handlers[0])
-    if p_config["netmiko_debug"] is not None:
-        nm_logger.setLevel(logging.DEBUG)
-        nm_log_fh = logging.FileHandler(str(p_config["netmiko_debug"]) + f"{os.getpid()}.log")
-        nm_logger.addHandler(nm_log_fh)
-    else:
-        nm_logger.addHandler(logging.NullHandler())
-    nm_logger.propagate = False
-    #
+    logger.info("running - %s", host)
     if jobfile_cache:
+        # Cache entries are (command, output filename) pairs, sanitized once in preload_jobfile
         jobfile = jobfile_cache
     elif jobfile:
-        jobfile = load_jobfile(jobfile)
+        jobfile = ((cmd, f"{sanitize_filename(cmd)}.txt") for cmd in load_jobfile(jobfile))
     else:
         jobfile = ()
     # Setup done, start actually working on the task at hand
@@ -81,43 +157,16 @@ def run(info: dict):
             # So dying hard here is acceptable to me.
             connection.enable()
             hostname = sanitize_filename(connection.find_prompt().split("#")[0])
-            if mode != OperatingModes.SaveOnly:
-                set_dir(original_directory / hostname)
-            logger.debug(f"run: Found hostname: {hostname} for {host}")
-            if mode == OperatingModes.Pull:
-                for cmd in jobfile:
-                    filename = f"{sanitize_filename(cmd)}.txt"
-                    logger.debug(f"run: Got filename: {filename} for {host}")
-                    with open(filename, "w") as output_file:
-                        output_file.write(connection.send_command(cmd))
-            elif mode == OperatingModes.Push:
-                # Filename here is not derived from any user controlled source, no need to run it through the sanitizer
-                filename = "configset.txt"
-                logger.debug(f"run: Got filename: {filename} for {host}")
-                try:
-                    with open(filename, "w") as output_file:
-                        output_file.write(connection.send_config_set(jobfile))
-                except NetmikoTimeoutException:
-                    # Pass this up to the outer try/except
-                    raise
-                finally:
-                    # No matter what happens, I don't want to leave a device without at least trying to save the config
-                    connection.save_config()
-            elif mode == OperatingModes.SaveOnly:
-                connection.save_config()
-                logger.info(f"Saved config for {host}")
-            else:
-                logger.critical(f"Unhandled Operating Mode: {mode = }")
-                raise RuntimeError("Unhandled Operating Mode: {mode = }")
+            if p_config["log_level"] <= logging.DEBUG:
+                logger.debug("run: Found hostname: %s for %s", hostname, host)
+            mode_handler(connection, hostname, jobfile, logger, host)
     except (NetmikoTimeoutException, NetmikoAuthenticationException) as err:
-        logger.critical(f"Exception in netmiko connection: {type(err).__name__}: {err}")
+        logger.critical("Exception in netmiko connection: %s: %s", type(err).__name__, err)
     except OSError as err:
-        logger.critical(f"Error writing file: {type(err).__name__}: {err}")
+        logger.critical("Error writing file: %s: %s", type(err).__name__, err)
     except Exception as err:
-        logger.critical(f"Unknown exception: {type(err).__name__}: {err}")
-    finally:
-        os.chdir(original_directory)
-    logger.info(f"finished -  {host}")
+        logger.critical("Unknown exception: %s: %s", type(err).__name__, err)
+    logger.info("finished -  %s", host)
 
 
 def handle_arguments() -> argparse.Namespace:
@@ -188,10 +237,13 @@ def main():
         log_level = logging.CRITICAL
     if args.verbose:
         log_level = logging.DEBUG
-    log_q = mp.Manager().Queue(-1)
+    # Plain mp.Queue: a Manager().Queue proxies every record through the manager server process
+    # (an extra pickle + socket hop per record) for no benefit here
+    log_q = mp.Queue(-1)
     logging_process = mp.Process(target=out_of_process_logger, args=(log_q, log_level))
+    # If main dies before posting the kill sentinel, don't leave an orphan logger holding the terminal
+    logging_process.daemon = True
     logging_process.start()
-    logger = logging.getLogger("nosmct")
     logger.addHandler(logging.handlers.QueueHandler(log_q))
     logger.setLevel(log_level)
     logger.info("Copyright Andrew Piroli 2019-2020")
@@ -205,7 +257,7 @@ def main():
     else:
         logger.critical("No operating mode selected from command line args")
         raise RuntimeError("No operating mode selected from command line args")
-    logger.info(f"Running in operating mode: {selected_mode}")
+    logger.info("Running in operating mode: %s", selected_mode)
     # TODO argparse can do validation (future self, you want to subclass `argparse.Action` override __call__)
     # Not sure it's worth it just yet, I'd even be fine crashing with invalid input especially since I *only* verify this one
     try:
@@ -213,8 +265,8 @@ def main():
         if NUM_THREADS < 1:
             raise RuntimeError(f"User input: {NUM_THREADS} - below 1, can not create less than 1 processes.")
     except (ValueError, RuntimeError) as err:
-        logger.critical(f"NUM_THREADS out of range: setting to default value of {NUM_THREADS_DEFAULT}")
-        logger.debug(f"{repr(err)}")
+        logger.critical("NUM_THREADS out of range: setting to default value of %s", NUM_THREADS_DEFAULT)
+        logger.debug("%r", err)
         NUM_THREADS = NUM_THREADS_DEFAULT
     if args.inventory:
         config = read_csv_config(abspath(args.inventory))
@@ -227,13 +279,12 @@ def main():
         args.jobfile = abspath(args.jobfile)
     netmiko_debug_file = abspath(".") / "netmiko." if args.debug_netmiko else None
     preloaded_jobfile = preload_jobfile(args.jobfile) if not args.no_preload else None
-    start_dir = abspath(".")
     if args.output_dir:
         output_dir = abspath(args.output_dir)
     else:
         output_dir = abspath("Output") / dtime.datetime.now().strftime("%Y-%m-%d %H.%M")
     if selected_mode != OperatingModes.SaveOnly:
-        set_dir(output_dir)
+        output_dir = ensure_dir(output_dir)
     p_config.update(
         {
             "mode": selected_mode,
@@ -244,43 +295,59 @@ def main():
             "output_dir": output_dir,
         }
     )
-    # Stackoverflow https://stackoverflow.com/a/63495323
-    # CC-BY-SA 4.0
-    # By: geitda https://stackoverflow.com/users/14133684/geitda
-    # Hopefully this improves Ctrl-C performance....
-    with ProcessPoolExecutor(max_workers=NUM_THREADS) as ex:
-        futures = [ex.submit(run, creds) for creds in config]
-        done, not_done = wait(futures, timeout=0)
+    mode_handler = MODE_HANDLERS[selected_mode]
+    # Threads, not processes: the workers spend their time blocked on SSH reads inside netmiko,
+    # so the GIL is irrelevant and we skip the fork + pickle cost per worker entirely
+    with ThreadPoolExecutor(
+        max_workers=NUM_THREADS, initializer=_init_worker, initargs=(p_config, log_q)
+    ) as ex:
+        futures = [ex.submit(run, creds, mode_handler) for creds in config]
         try:
-            while not_done:
-                freshly_done, not_done = wait(not_done, timeout=0.5)
-                done |= freshly_done
+            # as_completed blocks on the futures' condition variable: no CPU burned while jobs run
+            # and Ctrl-C is delivered immediately instead of on the next poll tick
+            for future in as_completed(futures):
+                # run() logs its own device-level failures; anything surfacing here is the pool
+                # itself breaking (unpicklable creds, a worker killed, ...) and shouldn't vanish
+                err = future.exception()
+                if err is not None:
+                    logger.critical("Worker failed unexpectedly: %s: %s", type(err).__name__, err)
         except KeyboardInterrupt:
-            for future in not_done:
+            for future in futures:
                 _ = future.cancel()
             logger.critical("Jobs cancelled, please wait for remaining jobs to finish.")
-            _ = wait(not_done, timeout=None)
-    # End Stackoverflow code
-    os.chdir(start_dir)
-    # We are back where we started
+            _ = wait(futures, timeout=None)
+    close_lnms_session()
     end = perf_counter_ns()
     elapsed = round((end - start) / 1000000, 3)
-    logger.info(f"Time Elapsed: {elapsed}ms")
+    logger.info("Time Elapsed: %sms", elapsed)
     log_q.put(THREAD_KILL_MSG)
     logging_process.join()
 
 
 def out_of_process_logger(log_q, level):
     logging.basicConfig(level=level)
-    logger = logging.getLogger("nosmct")
     logger.debug("Logger: Initialized")
+    # getLogger grabs the logging module's global lock every call, resolve each name once instead
+    # of once per record
+    known_loggers = {"nosmct": logger}
     while True:
         try:
-            record = log_q.get()
-            if record == THREAD_KILL_MSG:
-                break
-            logger = logging.getLogger(record.name)
-            logger.handle(record)
+            # Block for the first record, then drain whatever else is already queued so bursts
+            # from many workers are handled as one batch with one flush at the end. The batch is
+            # capped so a sustained flood still gets flushed to the terminal at a regular cadence.
+            records = [log_q.get()]
+            try:
+                while len(records) < 256:
+                    records.append(log_q.get_nowait())
+            except Empty:
+                pass
+            for record in records:
+                if record == THREAD_KILL_MSG:
+                    return
+                record_logger = known_loggers.get(record.name)
+                if record_logger is None:
+                    record_logger = known_loggers[record.name] = logging.getLogger(record.name)
+                record_logger.handle(record)
         except Exception:
             import traceback
 